@@ -1,73 +1,175 @@
 import streamlit as st
-from PIL import Image, ImageEnhance
+from PIL import Image, ImageOps
 import pandas as pd
 import pytesseract
 import re
-from fpdf import FPDF
-import tempfile
 import os
 import io
-import yagmail
 import json
-from openai import OpenAI, RateLimitError
+from openai import OpenAI, OpenAIError, RateLimitError
 import numpy as np
 import time
+import threading
+import atexit
+import smtplib
+from email.message import EmailMessage
+
+try:
+    from tesserocr import PyTessBaseAPI, PSM, OEM
+except ImportError:  # optional; fall back to the pytesseract subprocess
+    PyTessBaseAPI = None
 
 # --- OpenAI Client Setup ---
-client = OpenAI(api_key=st.secrets["openai_api_key"] if "openai_api_key" in st.secrets else os.getenv("OPENAI_API_KEY"))
+@st.cache_resource
+def get_openai_client():
+    # One client (and its HTTP connection pool) per process, shared by every rerun and session
+    return OpenAI(api_key=st.secrets["openai_api_key"] if "openai_api_key" in st.secrets else os.getenv("OPENAI_API_KEY"))
+
+# --- Static Assets ---
+LOGO_PATH = "logo.png"
+
+@st.cache_resource
+def get_logo_bytes():
+    # Read once per process instead of on every rerun and every PDF
+    if not os.path.exists(LOGO_PATH):
+        return None
+    with open(LOGO_PATH, "rb") as f:
+        return f.read()
+
+# --- Precompiled Patterns ---
+_AMOUNT = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?"  # 1,250.00 | 45.00 | 45
+_ITEM_RE = re.compile(
+    rf"(.+?)\s+(?:x?(\d+)\s+)?({_AMOUNT})\s+({_AMOUNT})(?:\s*(?:EGP|L\.?E\.?|جنيه))?$",
+    re.IGNORECASE
+)
+_NUMBER_RE = re.compile(r"\d[\d,.]*")
 
 # --- OCR with Tesseract ---
+OCR_MAX_SIDE = 1600  # px; Tesseract runtime scales with pixel count
+TESSERACT_CONFIG = "--oem 1 --psm 6"  # LSTM only, single uniform text block
+
+@st.cache_resource
+def get_tesseract_api():
+    # Loaded once per process so traineddata stays resident; the API is not thread-safe, hence the lock.
+    # None means "use the pytesseract subprocess instead"
+    if PyTessBaseAPI is None:
+        return None
+    try:
+        api = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
+    except RuntimeError:  # e.g. tessdata not found, common with pip wheels
+        return None
+    return api, threading.Lock()
+
 def extract_text_tesseract(image):
     if isinstance(image, np.ndarray):
         image = Image.fromarray(image)
     elif not isinstance(image, Image.Image):
         image = Image.open(image)
 
+    # For JPEGs, let the decoder scale down by 1/2-1/8 and emit greyscale directly, so full-resolution
+    # RGB pixels are never materialised; a no-op for other formats and already-loaded images.
+    # draft() only reduces while both sides stay >= the request, so ask for the aspect-correct target
+    scale = min(1.0, OCR_MAX_SIDE / max(image.size))
+    image.draft("L", (int(image.width * scale), int(image.height * scale)))
     image = image.convert("L")
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(2.0)
-
-    text = pytesseract.image_to_string(image)
-    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    if max(image.size) > OCR_MAX_SIDE:
+        image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    # Equivalent of ImageEnhance.Contrast(2.0) (stretch around the mean grey level) as a single LUT pass,
+    # without allocating the flat "degenerate" image and blending against it
+    histogram = image.histogram()
+    mean = int(sum(level * count for level, count in enumerate(histogram)) / sum(histogram) + 0.5)
+    image = image.point([min(255, max(0, mean + 2 * (level - mean))) for level in range(256)])
+
+    tesseract_api = get_tesseract_api()
+    if tesseract_api is not None:
+        api, lock = tesseract_api
+        with lock:
+            api.SetImage(image)
+            text = api.GetUTF8Text()
+    else:
+        text = pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+    lines = [line for line in map(str.strip, text.splitlines()) if line]
     return lines
 
-# --- Fallback OCR Parsing ---
+@st.cache_data(show_spinner=False, max_entries=64)
+def ocr_lines(image_bytes):
+    return extract_text_tesseract(io.BytesIO(image_bytes))
+
+# --- Upload Preview ---
+PREVIEW_MAX_SIDE = 1200  # px; the rendered image is narrower than this anyway
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def preview_image(image_bytes):
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        if max(image.size) <= PREVIEW_MAX_SIDE:
+            return image_bytes
+        # Re-encoding drops EXIF, so bake the phone's rotation tag into the pixels first
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE), Image.LANCZOS)
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+# --- Regex OCR Parsing ---
+def is_item_candidate(line):
+    # Anything with a price and a total (two numeric tokens) might be an item line
+    return len(_NUMBER_RE.findall(line)) >= 2
+
 def basic_ocr_parse(lines):
-    items = []
-    item_pattern = re.compile(r"(.+?)\\s+x?(\\d+)?\\s+([\\d.]+)\\s+([\\d.]+)$")
+    # Also returns how many lines looked like items, so callers can tell whether any were left unmatched
+    names, qtys, unit_prices, totals = [], [], [], []
+    candidates = 0
 
     for line in lines:
-        match = item_pattern.search(line)
+        # Reject headers and notes before running the backtracking regex
+        if not is_item_candidate(line):
+            continue
+        candidates += 1
+        match = _ITEM_RE.search(line)
         if match:
-            item_name = match.group(1).strip()
-            qty = int(match.group(2)) if match.group(2) else 1
-            unit_price = float(match.group(3))
-            total = float(match.group(4))
-            items.append({
-                "Item": item_name,
-                "Qty": qty,
-                "Unit Price": unit_price,
-                "Total": total
-            })
-
-    if items:
-        st.info("✅ Fallback OCR parsing succeeded.")
-    else:
-        st.warning("⚠️ No items detected with fallback OCR parsing.")
-
-    return pd.DataFrame(items)
+            names.append(match.group(1).strip())
+            qtys.append(int(match.group(2)) if match.group(2) else 1)
+            unit_prices.append(float(match.group(3).replace(",", "")))
+            totals.append(float(match.group(4).replace(",", "")))
+
+    df = pd.DataFrame({
+        "Item": names,
+        "Qty": np.array(qtys, dtype=np.int64),
+        "Unit Price": np.array(unit_prices, dtype=np.float64),
+        "Total": np.array(totals, dtype=np.float64)
+    })
+    return df, candidates
+
+def is_confident_parse(df, candidates):
+    # Trust the regex result only when it reads as a complete itemised bill: no item-like line was
+    # left unmatched, several rows, positive quantities, and every line total equal to qty x unit price
+    if len(df) < 2 or len(df) != candidates:
+        return False
+    if not (df["Qty"] > 0).all():
+        return False
+    expected = df["Qty"].to_numpy() * df["Unit Price"].to_numpy()
+    return bool(np.allclose(expected, df["Total"].to_numpy(), atol=0.01))
+
+# --- GPT Parsing with Retry ---
+class InvoiceParseError(Exception):
+    pass
 
-# --- GPT Parsing with Retry + Fallback ---
 def parse_with_gpt(text_lines):
     prompt = (
         "You are an intelligent invoice parser. From the following lines, extract items with:\n"
         "- Item (string)\n- Qty (int)\n- Unit Price (float)\n- Total (float)\n\n"
-        "Return a valid JSON array, like:\n"
-        "[{\"Item\": \"سلطة طحينة\", \"Qty\": 2, \"Unit Price\": 40.0, \"Total\": 80.0}]\n\n"
+        "Return a JSON object with an \"items\" array, like:\n"
+        "{\"items\": [{\"Item\": \"سلطة طحينة\", \"Qty\": 2, \"Unit Price\": 40.0, \"Total\": 80.0}]}\n\n"
         f"Lines:\n{chr(10).join(text_lines)}"
     )
 
-    models = ["gpt-3.5-turbo", "gpt-4"]
+    try:
+        client = get_openai_client()
+    except OpenAIError as e:  # e.g. no API key configured
+        st.error(f"❌ OpenAI client unavailable: {e}")
+        raise InvoiceParseError(str(e)) from e
+
+    models = ["gpt-3.5-turbo", "gpt-4o"]  # both support JSON mode
     max_retries = 5
     delay = 2  # seconds
 
@@ -78,7 +180,8 @@ def parse_with_gpt(text_lines):
                 response = client.chat.completions.create(
                     model=model,
                     messages=[{"role": "user", "content": prompt}],
-                    temperature=0.2
+                    temperature=0.2,
+                    response_format={"type": "json_object"}
                 )
                 content = response.choices[0].message.content
 
@@ -86,11 +189,23 @@ def parse_with_gpt(text_lines):
                 st.code(content)
 
                 try:
-                    data = json.loads(content)
-                    return pd.DataFrame(data)
-                except Exception as e:
-                    st.error(f"Failed to parse GPT output: {e}")
-                    return pd.DataFrame()
+                    items = json.loads(content)["items"]
+                    if not isinstance(items, list):
+                        raise TypeError(f"\"items\" is a {type(items).__name__}, not a list")
+                    if not items:
+                        raise ValueError("\"items\" is empty")
+                    df = pd.DataFrame(items)
+                    missing = [col for col in ("Item", "Qty", "Unit Price", "Total") if col not in df.columns]
+                    if missing:
+                        raise ValueError(f"items are missing {missing}")
+                    df = df[["Item", "Qty", "Unit Price", "Total"]]
+                    # The UI formats these with :.2f, so "80.00" strings must not get through (or into the cache)
+                    for col in ("Qty", "Unit Price", "Total"):
+                        df[col] = pd.to_numeric(df[col], errors="raise")
+                    return df
+                except (ValueError, KeyError, TypeError) as e:
+                    st.error(f"Failed to parse GPT output: {e!r}")
+                    break  # try next model
 
             except RateLimitError:
                 st.warning(f"⚠️ Rate limit hit on {model}. Retrying in {delay} seconds...")
@@ -103,57 +218,157 @@ def parse_with_gpt(text_lines):
 
         st.warning(f"⚠️ Switching to backup model after retries with {model} failed.")
 
-    st.error("❌ All models failed. Falling back to basic OCR extraction...")
-    return basic_ocr_parse(text_lines)
+    raise InvoiceParseError(f"All models failed: {', '.join(models)}")
+
+# --- Item Parsing ---
+# Persisted to disk so parsed receipts survive restarts. Streamlit writes the pickles to ~/.streamlit/cache
+# (the running user's home, not this project), and max_entries only bounds the in-memory layer: customer
+# receipts stay there indefinitely until someone runs `streamlit cache clear`.
+@st.cache_data(show_spinner=False, max_entries=64, persist="disk")
+def parse_items(text_lines):
+    # Returns only confident regex or successful GPT results; failures raise so they are never cached
+    df, candidates = basic_ocr_parse(text_lines)
+    if is_confident_parse(df, candidates):
+        st.info("✅ Items read directly from the OCR text; GPT not needed.")
+        return df
+    return parse_with_gpt(text_lines)
+
+def parse_items_with_fallback(text_lines, upload_id):
+    # Failures stay out of the persisted cache, but the fallback for the current receipt is kept for the
+    # session so widget reruns don't go back to OpenAI (and its backoff sleeps) or reshuffle the rows
+    key = (upload_id, tuple(text_lines))  # a fresh upload of the same photo gets a new id, so it retries
+    cached = st.session_state.get("_fallback_items")
+    if cached is not None and cached[0] == key:
+        st.warning("⚠️ GPT parsing failed for this receipt; showing the basic OCR result.")
+        if not st.button("🔁 Retry GPT parsing"):
+            return cached[1]
+        del st.session_state["_fallback_items"]
+
+    try:
+        return parse_items(text_lines)
+    except InvoiceParseError:
+        st.error("❌ All models failed. Falling back to basic OCR extraction...")
+    df, _ = basic_ocr_parse(text_lines)
+    if df.empty:
+        st.warning("⚠️ No items detected with fallback OCR parsing.")
+    else:
+        st.info("✅ Fallback OCR parsing succeeded.")
+    st.session_state["_fallback_items"] = (key, df)
+    return df
+
+# --- Bill Summary ---
+def summarize(totals, service_pct, vat_pct, tip):
+    # Pure function of the selected totals, so the on-screen summary and the PDF share one calculation
+    subtotal = float(totals.sum())
+    service = subtotal * (service_pct / 100.0)
+    vat = (subtotal + service) * (vat_pct / 100.0)
+    return {
+        "Subtotal": subtotal,
+        "Service Charge": service,
+        "VAT": vat,
+        "Tip": tip,
+        "Total Due": subtotal + service + vat + tip
+    }
 
 # --- PDF Generator ---
-def generate_pdf(df_selected, summary, per_person, filename="invoice.pdf"):
+@st.cache_data(show_spinner=False, max_entries=16)  # each PDF embeds the ~1.3 MB logo
+def generate_pdf(df_selected, summary, per_person):
+    from fpdf import FPDF  # imported lazily: only needed when a PDF is requested
+
     pdf = FPDF()
     pdf.add_page()
-    pdf.set_font("Arial", size=12)
+    pdf.set_font("Helvetica", size=12)
 
-    logo_path = "logo.png"
-    if os.path.exists(logo_path):
-        pdf.image(logo_path, x=10, y=8, w=40)
+    logo = get_logo_bytes()
+    if logo:
+        pdf.image(io.BytesIO(logo), x=10, y=8, w=40)
         pdf.ln(30)
     else:
         pdf.ln(10)
 
-    pdf.set_font("Arial", 'B', 14)
-    pdf.cell(200, 10, txt="Invoice Summary", ln=True, align='C')
-    pdf.set_font("Arial", size=12)
+    pdf.set_font("Helvetica", 'B', 14)
+    pdf.cell(200, 10, text="Invoice Summary", new_x="LMARGIN", new_y="NEXT", align='C')
+    pdf.set_font("Helvetica", size=12)
     pdf.ln(5)
 
-    for index, row in df_selected.iterrows():
-        pdf.cell(200, 10, txt=f"{row['Item']} - Qty: {row['Qty']} - Unit: {row['Unit Price']} - Total: {row['Total']}", ln=True)
+    rows = zip(
+        df_selected["Item"].tolist(),
+        df_selected["Qty"].tolist(),
+        df_selected["Unit Price"].tolist(),
+        df_selected["Total"].tolist()
+    )
+    item_lines = [
+        f"{item} - Qty: {qty} - Unit: {unit_price} - Total: {total}"
+        for item, qty, unit_price, total in rows
+    ]
+    pdf.multi_cell(200, 10, text="\n".join(item_lines), new_x="LMARGIN", new_y="NEXT")
 
     pdf.ln(5)
-    for k, v in summary.items():
-        pdf.cell(200, 10, txt=f"{k}: EGP {v:.2f}", ln=True)
+    summary_lines = [f"{k}: EGP {v:.2f}" for k, v in summary.items()]
+    summary_lines.append(f"Total: EGP {per_person:.2f}")
+    pdf.multi_cell(200, 10, text="\n".join(summary_lines), new_x="LMARGIN", new_y="NEXT")
 
-    pdf.cell(200, 10, txt=f"Total: EGP {per_person:.2f}", ln=True)
-
-    path = os.path.join(tempfile.gettempdir(), filename)
-    pdf.output(path)
-    return path
+    # Render in memory: no temp file to re-read, no filename shared between users
+    return bytes(pdf.output())
 
 # --- Email Invoice ---
-def send_email(recipient, subject, body, attachment_path):
+SMTP_HOST = "smtp.gmail.com"  # Gmail over implicit TLS, as yagmail used
+SMTP_PORT = 465
+
+@st.cache_resource
+def get_smtp_pool():
+    # Holds one logged-in connection per process; smtplib is not thread-safe, hence the lock
+    pool = {"conn": None}
+    atexit.register(lambda: pool["conn"] and pool["conn"].close())
+    return pool, threading.Lock()
+
+def _smtp_connection(pool, sender, password):
+    conn = pool["conn"]
+    if conn is not None:
+        try:
+            if conn.noop()[0] == 250:
+                return conn
+        except (smtplib.SMTPException, OSError):
+            pass
+        conn.close()  # stale: the server dropped the idle connection
+    conn = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30)
+    try:
+        conn.login(sender, password)
+    except (smtplib.SMTPException, OSError):
+        conn.close()  # don't leak the socket on e.g. SMTPAuthenticationError
+        raise
+    pool["conn"] = conn
+    return conn
+
+def send_email(recipient, subject, body, pdf_bytes, filename):
     sender = os.environ.get("EMAIL_USER")
     password = os.environ.get("EMAIL_PASS")
     if not sender or not password:
         st.error("❌ Email credentials not set in environment variables.")
-        return
-    yag = yagmail.SMTP(sender, password)
-    yag.send(to=recipient, subject=subject, contents=body, attachments=attachment_path)
+        return False
+
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(body)
+    message.add_attachment(pdf_bytes, maintype="application", subtype="pdf", filename=filename)
+
+    pool, lock = get_smtp_pool()
+    try:
+        with lock:
+            _smtp_connection(pool, sender, password).send_message(message)
+    except (smtplib.SMTPException, OSError) as e:
+        st.error(f"❌ Failed to send the email: {e}")
+        return False
     return True
 
 # --- Streamlit App UI ---
 st.set_page_config(page_title="Yalla Split & Pay", page_icon="💸")
 
-logo_path = "logo.png"
-if os.path.exists(logo_path):
-    st.image(logo_path, width=150)
+logo = get_logo_bytes()
+if logo:
+    st.image(logo, width=150)
 
 st.title("💸 Yalla Split & Pay")
 st.write("Upload your invoice image, extract items, choose what you had, and get your share!")
@@ -161,63 +376,59 @@ st.write("Upload your invoice image, extract items, choose what you had, and get
 uploaded_image = st.file_uploader("📸 Upload an invoice image", type=["png", "jpg", "jpeg"])
 
 if uploaded_image:
-    image = Image.open(uploaded_image)
-    st.image(image, caption="Uploaded Image", use_container_width=True)
+    image_bytes = uploaded_image.getvalue()
+    st.image(preview_image(image_bytes), caption="Uploaded Image", use_container_width=True)
 
     with st.spinner("🧠 Extracting items from invoice using GPT..."):
-        text_lines = extract_text_tesseract(image)
-        df = parse_with_gpt(text_lines)
+        text_lines = ocr_lines(image_bytes)
+        df = parse_items_with_fallback(text_lines, uploaded_image.file_id)
 
     if not df.empty:
         st.success("✅ Items extracted successfully!")
         st.write("### 🛒 Select your items")
 
-        selected_rows = st.multiselect(
-            "Select what you personally ordered:",
-            options=df.index,
-            format_func=lambda i: f"{df.at[i, 'Qty']}x {df.at[i, 'Item']} - EGP {df.at[i, 'Total']:.2f}"
-        )
-
-        if selected_rows:
-            df_selected = df.loc[selected_rows]
-            st.dataframe(df_selected)
-
-            st.subheader("💰 Your Personal Summary")
+        item_labels = [
+            f"{qty}x {item} - EGP {total:.2f}"
+            for qty, item, total in zip(df["Qty"].tolist(), df["Item"].tolist(), df["Total"].tolist())
+        ]
+
+        # Batch edits into one rerun: form widgets only report new values when the form is submitted
+        with st.form("split_form"):
+            selected_rows = st.multiselect(
+                "Select what you personally ordered:",
+                options=range(len(df)),
+                format_func=item_labels.__getitem__
+            )
             service_charge = st.number_input("Service Charge %", value=12.0, key="your_service")
             vat = st.number_input("VAT %", value=14.0, key="your_vat")
             tip = st.number_input("Optional Tip (EGP)", value=0.0, key="your_tip")
+            st.form_submit_button("🧮 Calculate My Share")
 
-            personal_subtotal = df_selected["Total"].sum()
-            personal_service = personal_subtotal * (service_charge / 100)
-            personal_vat = (personal_subtotal + personal_service) * (vat / 100)
-            personal_total = personal_subtotal + personal_service + personal_vat + tip
+        if selected_rows:
+            df_selected = df.iloc[selected_rows]
+            st.dataframe(df_selected)
 
-            summary = {
-                "Subtotal": personal_subtotal,
-                "Service Charge": personal_service,
-                "VAT": personal_vat,
-                "Tip": tip,
-                "Total Due": personal_total
-            }
+            st.subheader("💰 Your Personal Summary")
+            summary = summarize(df_selected["Total"].to_numpy(dtype=np.float64), service_charge, vat, tip)
+            personal_total = summary["Total Due"]
 
             st.write(summary)
             st.markdown(f"### 💸 You Owe: **EGP {personal_total:.2f}**")
 
             if st.button("📄 Generate Your Invoice PDF"):
-                pdf_path = generate_pdf(df_selected, summary, per_person=personal_total)
-                with open(pdf_path, "rb") as f:
-                    st.download_button("Download Your PDF", f, file_name="my_invoice.pdf")
+                pdf_bytes = generate_pdf(df_selected, summary, per_person=personal_total)
+                st.download_button("Download Your PDF", pdf_bytes, file_name="my_invoice.pdf", mime="application/pdf")
 
             with st.expander("📧 Send Your Invoice by Email"):
                 email = st.text_input("Your Email")
                 subject = st.text_input("Email Subject", value="My Split Invoice")
                 body = st.text_area("Email Body", value="Here’s the part I’m paying for.")
                 if st.button("Send My Part via Email"):
-                    pdf_path = generate_pdf(df_selected, summary, per_person=personal_total)
-                    result = send_email(email, subject, body, pdf_path)
+                    pdf_bytes = generate_pdf(df_selected, summary, per_person=personal_total)
+                    result = send_email(email, subject, body, pdf_bytes, "my_invoice.pdf")
                     if result:
                         st.success("📤 Email sent successfully!")
         else:
-            st.info("Select the items you personally ordered to see your total.")
+            st.info("Select the items you personally ordered and press Calculate to see your total.")
     else:
         st.warning("⚠️ No items were detected. Try a clearer image or check the GPT response above.")